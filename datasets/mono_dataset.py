@@ -51,7 +51,9 @@ class MonoDataset(data.Dataset):
         super(MonoDataset, self).__init__()
 
         self.data_path = data_path
-        self.filenames = filenames
+        # stored as a numpy array rather than a list of python strings, so that the forked
+        # dataloader workers do not touch (and copy) the refcounts of every element
+        self.filenames = np.array(filenames)
         self.height = height
         self.width = width
         self.num_scales = num_scales
@@ -14,68 +14,83 @@ CY = 493.378998
 # center crop 50% vertically
 CROP_AREA = [0, 240, 1280, 720]
 
+
+def pil_crop_loader(path, crop_area):
+    """Open an image and crop it before the RGB conversion, so that the pixels outside
+    crop_area are never colour converted
+    """
+    # open path as file to avoid ResourceWarning
+    # (https://github.com/python-pillow/Pillow/issues/835)
+    with open(path, 'rb') as f:
+        with pil.open(f) as img:
+            return img.crop(tuple(crop_area)).convert('RGB')
+
+
+# NOTE: Make sure your intrinsics matrix is *normalized* by the original image size.
+# To normalize you need to scale the first row by 1 / image_width and the second row
+# by 1 / image_height. Monodepth2 assumes a principal point to be exactly centered.
+# If your principal point is far from the center you might need to disable the horizontal
+# flip augmentation.
+
+# Monodepth2 assumes a principal point to be exactly centered
+# stereo wide
+# intrinsics:  983.044006,  983.044006, 643.646973, 493.378998
+# se effettuo del crop, fx e fy rimangono gli stessi
+# vengono modificati cx e cy secondo questo
+    # https://github.com/BerkeleyAutomation/perception/blob/6b7bfadae206b130dce21b63034d70211ba7a9f8/perception/camera_intrinsics.py#L184
+
+# Valori precalcolati per CROP_AREA = [0, 240, 1280, 720] (vedi la docstring di OXFORDDataset
+# per la verifica); se CROP_AREA cambia vanno ricalcolati
+# fx = FX / WIDTH, fy = FY / HEIGHT
+_FX = 0.7680031296875
+_FY = 1.0240041729166667
+# crop_cx = (CX + (crop_width - 1) / 2 - crop_cj) / WIDTH
+# crop_cy = (CY + (crop_height - 1) / 2 - crop_ci) / WIDTH
+# con crop_ci, crop_cj riga e colonna del centro della finestra di crop
+_CROP_CX = 0.5024585726562499
+_CROP_CY = 0.1975617171875
+
+_K_OXFORD = np.array([[_FX, 0, _CROP_CX, 0],
+                      [0, _FY, _CROP_CY, 0],
+                      [0, 0, 1, 0],
+                      [0, 0, 0, 1]], dtype=np.float32)
+
+
 class OXFORDDataset(MonoDataset):
     """
     Super class for different types of OXFORD dataset loaders
+
+    The precomputed intrinsics match the ones computed from the camera parameters and CROP_AREA:
+
+    >>> crop_width = CROP_AREA[2] - CROP_AREA[0]
+    >>> crop_height = CROP_AREA[3] - CROP_AREA[1]
+    >>> crop_ci = CROP_AREA[3] - (crop_height / 2)
+    >>> crop_cj = CROP_AREA[2] - (crop_width / 2)
+    >>> crop_cx = (CX + float(crop_width - 1) / 2 - crop_cj) / WIDTH
+    >>> crop_cy = (CY + float(crop_height - 1) / 2 - crop_ci) / WIDTH
+    >>> np.allclose(_K_OXFORD[:2, :3], [[FX / WIDTH, 0, crop_cx], [0, FY / HEIGHT, crop_cy]])
+    True
     """
     def __init__(self, *args, **kwargs):
         super(OXFORDDataset, self).__init__(*args, **kwargs)
 
-        # NOTE: Make sure your intrinsics matrix is *normalized* by the original image size.
-        # To normalize you need to scale the first row by 1 / image_width and the second row
-        # by 1 / image_height. Monodepth2 assumes a principal point to be exactly centered.
-        # If your principal point is far from the center you might need to disable the horizontal
-        # flip augmentation.
-
-        # Monodepth2 assumes a principal point to be exactly centered
-        # stereo wide
-        # intrinsics:  983.044006,  983.044006, 643.646973, 493.378998
-        # se effettuo del crop, fx e fy rimangono gli stessi
-        # vengono modificati cx e cy secondo questo
-            # https://github.com/BerkeleyAutomation/perception/blob/6b7bfadae206b130dce21b63034d70211ba7a9f8/perception/camera_intrinsics.py#L184
-
-
-        fx = FX / WIDTH
-        fy = FY / HEIGHT
-        # Parameters
-        # ----------
-        # crop_height : int
-        #     height of crop window
-        # crop_width : int
-        #     width of crop window
-        # crop_ci : int
-        #     row of crop window center
-        # crop_cj : int
-        #     col of crop window center
+        # MonoDataset.__getitem__ works on a copy of self.K, so the matrix can be shared
+        self.K = _K_OXFORD
         self.crop_area = CROP_AREA
-        crop_width = self.crop_area[2] - self.crop_area[0]
-        crop_height = self.crop_area[3] - self.crop_area[1]
-        crop_ci = self.crop_area[3] - (crop_height / 2)
-        crop_cj = self.crop_area[2] - (crop_width / 2)
-        self.crop_cx = CX + float(crop_width-1)/2 - crop_cj
-        self.crop_cy = CY + float(crop_height-1)/2 - crop_ci
-        self.crop_cx /= WIDTH
-        self.crop_cy /= WIDTH
-
-        # self.crop_cx = 209.18526622500002
-        # self.crop_cy = 65.78386640000001
-
-
-        self.K = np.array([[fx, 0, self.crop_cx, 0],
-                           [0, fy, self.crop_cy, 0],
-                           [0, 0, 1, 0],
-                           [0, 0, 0, 1]], dtype=np.float32)
+        self.crop_cx = _CROP_CX
+        self.crop_cy = _CROP_CY
 
         self.side_map = {"l": "left", "r": "right"}
 
-        print('width:', WIDTH)
-        print('height:', HEIGHT)
-        print('fx:', fx)
-        print('fy:', fy)
-        print('crop_width:', crop_width)
-        print('crop_height:', crop_height)
-        print('crop_cx:', self.crop_cx)
-        print('crop_cy:', self.crop_cy, '\n')
+        if os.environ.get("OXFORD_VERBOSE"):
+            print('width:', WIDTH)
+            print('height:', HEIGHT)
+            print('fx:', _FX)
+            print('fy:', _FY)
+            print('crop_width:', CROP_AREA[2] - CROP_AREA[0])
+            print('crop_height:', CROP_AREA[3] - CROP_AREA[1])
+            print('crop_cx:', self.crop_cx)
+            print('crop_cy:', self.crop_cy, '\n')
 
 
     def check_depth(self):
@@ -89,7 +104,8 @@ class OXFORDDataset(MonoDataset):
         """
         Horizontal flip augmentation.
         """
-        color = self.loader(self.get_image_path(folder, frame_index, side))
+        # the crop is done while loading, before any other transform
+        color = pil_crop_loader(self.get_image_path(folder, frame_index, side), self.crop_area)
 
         if self.mytransform is not None:
             color = self.mytransform(color, self.crop_area)
@@ -25,6 +25,18 @@ def disp_to_depth(disp, min_depth, max_depth):
     return scaled_disp, depth
 
 
+@torch.jit.script
+def fast_disp_to_depth(disp, min_depth: float, max_depth: float, scale: float):
+    """Convert network's sigmoid output into depth multiplied by scale (e.g. a stereo
+    scale factor to get metric depth), as one scripted function so that the element-wise
+    operations can be fused
+    """
+    min_disp = 1.0 / max_depth
+    max_disp = 1.0 / min_depth
+    scaled_disp = min_disp + (max_disp - min_disp) * disp
+    return scale / scaled_disp
+
+
 def transformation_from_parameters(axisangle, translation, invert=False):
     """Convert the network's (axisangle, translation) output into a 4x4 matrix
     """
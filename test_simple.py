@@ -12,21 +12,33 @@ import glob
 import argparse
 import numpy as np
 import PIL.Image as pil
-import matplotlib as mpl
 import matplotlib.cm as cm
 
 import torch
-from torchvision import transforms, datasets
+from torch.utils.data import Dataset, DataLoader
+from torchvision import datasets
 
 import networks
-from layers import disp_to_depth
+from layers import disp_to_depth, fast_disp_to_depth
 from utils import download_model_if_doesnt_exist, readlines
 from evaluate_depth import STEREO_SCALE_FACTOR
 
+# NVIDIA DALI is only needed for the --dali preprocessing path
+try:
+    from nvidia.dali import pipeline_def, fn, types
+    from nvidia.dali.plugin.base_iterator import LastBatchPolicy
+    from nvidia.dali.plugin.pytorch import DALIGenericIterator
+except ImportError:
+    pipeline_def = None
+
 test_files_dir = '/home/radice/neuralNetworks/monodepth2/splits'
 kitti_path = '/home/radice/neuralNetworks/results/monodepth2/KITTI/'
 oxford_path = '/home/radice/neuralNetworks/results/monodepth2/OXFORD/'
 
+# magma colormap as a 256 entry uint8 lookup table (768 bytes), indexed directly with the
+# normalized disparities instead of going through matplotlib's float64 RGBA conversion
+_MAGMA_LUT = (cm.magma(np.arange(256))[:, :3] * 255).astype(np.uint8)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -79,9 +91,284 @@ def parse_args():
     parser.add_argument("--resnet",
                         type=int,
                         default=18)
+    parser.add_argument("--batch_size",
+                        type=int,
+                        help='number of images fed to the network at once',
+                        default=32)
+    parser.add_argument("--num_workers",
+                        type=int,
+                        help='number of dataloader workers used for preprocessing',
+                        default=8)
+    parser.add_argument("--compile",
+                        help='if set, compiles encoder and decoder with torch.compile (torch >= 2.0) '
+                             'before predicting, warming up on the full and last batch shapes',
+                        action='store_true')
+    parser.add_argument("--dali",
+                        help='if set, decodes and preprocesses the images on the GPU with NVIDIA DALI',
+                        action='store_true')
     return parser.parse_args()
 
 
+class InferenceDataset(Dataset):
+    """Loads and crops the test images so that decoding runs in the dataloader workers
+    while the network predicts on the previous batch
+    """
+    def __init__(self, paths, crop_area=None):
+        super(InferenceDataset, self).__init__()
+
+        # numpy array, so that the forked workers do not copy the list of paths
+        self.paths = np.array(paths)
+        self.crop_area = crop_area
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        """Returns the cropped image as an HxWx3 uint8 tensor, its path and its
+        (height, width). The float conversion and the resize are left to the device so that
+        a quarter of the bytes are copied to the GPU.
+        """
+        image_path = str(self.paths[index])
+        input_image = pil.open(image_path)
+
+        # effettuo il crop dell'immagine se il dataset è OXFORD
+        # (prima della conversione RGB, cosi i pixel scartati non vengono convertiti)
+        if self.crop_area is not None:
+            input_image = input_image.crop(self.crop_area)
+        input_image = input_image.convert('RGB')
+
+        original_width, original_height = input_image.size
+
+        return torch.from_numpy(np.array(input_image)), image_path, (original_height, original_width)
+
+
+def collate_images(batch):
+    """Keeps the images of a batch as a list, since before the resize their sizes can differ
+    (e.g. across KITTI sequences)
+    """
+    input_images, image_paths, original_sizes = zip(*batch)
+    return list(input_images), list(image_paths), list(original_sizes)
+
+
+def to_network_input(input_images, feed_height, feed_width, device):
+    """Copies a list of HxWx3 uint8 images to the device, and resizes and converts them
+    there to a Bx3xfeed_heightxfeed_width batch of floats in [0, 1]
+    """
+    resized_images = []
+    for input_image in input_images:
+        input_image = input_image.to(device, non_blocking=True)
+        input_image = input_image.permute(2, 0, 1).unsqueeze(0).float()
+        # antialiased bilinear, close to the LANCZOS resize used during training
+        resized_images.append(torch.nn.functional.interpolate(
+            input_image, (feed_height, feed_width), mode="bilinear", align_corners=False,
+            antialias=True))
+    return torch.cat(resized_images).mul_(1.0 / 255.0)
+
+
+class DataPrefetcher(object):
+    """Copies the next batch to the GPU on a side CUDA stream, so that the host to device
+    transfer overlaps with the prediction on the current batch.
+    Adapted from the data_prefetcher of the NVIDIA apex ImageNet example.
+    """
+    def __init__(self, dataloader, feed_height, feed_width, device):
+        self.dataloader = iter(dataloader)
+        self.feed_height = feed_height
+        self.feed_width = feed_width
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.preload()
+
+    def preload(self):
+        try:
+            input_images, self.next_paths, self.next_sizes = next(self.dataloader)
+        except StopIteration:
+            self.next_images = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_images = to_network_input(
+                input_images, self.feed_height, self.feed_width, self.device)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        if self.next_images is None:
+            raise StopIteration
+        input_images = self.next_images
+        # the batch was allocated on the side stream but is consumed by the current one
+        input_images.record_stream(torch.cuda.current_stream())
+        image_paths, original_sizes = self.next_paths, self.next_sizes
+        self.preload()
+        return input_images, image_paths, original_sizes
+
+
+def load_batches(paths, feed_width, feed_height, crop_area, device, args):
+    """Returns an iterator over (images, paths, original (height, width) sizes) batches, with the images
+    already on the device as Bx3xHxW floats in [0, 1]
+    """
+    dataset = InferenceDataset(paths, crop_area)
+    loader_kwargs = {}
+    if args.num_workers > 0:
+        loader_kwargs["prefetch_factor"] = 4
+    dataloader = DataLoader(dataset, args.batch_size, shuffle=False,
+                            num_workers=args.num_workers, pin_memory=device.type == "cuda", drop_last=False,
+                            collate_fn=collate_images, **loader_kwargs)
+
+    if device.type == "cuda":
+        return DataPrefetcher(dataloader, feed_height, feed_width, device)
+    return ((to_network_input(input_images, feed_height, feed_width, device),
+             image_paths, original_sizes)
+            for input_images, image_paths, original_sizes in dataloader)
+
+
+def load_batches_dali(paths, feed_width, feed_height, crop_area, device, args):
+    """Same as load_batches, but the JPEG decoding (nvJPEG), crop, resize, normalization
+    and HWC->CHW transpose all run on the GPU in a DALI pipeline
+    """
+    assert pipeline_def is not None, "--dali requires NVIDIA DALI to be installed"
+    assert device.type == "cuda", "--dali can only be used on a CUDA device"
+
+    @pipeline_def
+    def inference_pipe():
+        jpegs, _ = fn.readers.file(files=paths, random_shuffle=False, name="Reader")
+        if crop_area is not None:
+            # region of interest decoding: only the crop is decoded
+            crop_width = crop_area[2] - crop_area[0]
+            crop_height = crop_area[3] - crop_area[1]
+            images = fn.decoders.image_slice(
+                jpegs, device='mixed', output_type=types.RGB, axis_names="WH",
+                start=[crop_area[0], crop_area[1]], shape=[crop_width, crop_height])
+            shapes = fn.constant(idata=[crop_height, crop_width, 3])
+        else:
+            images = fn.decoders.image(jpegs, device='mixed', output_type=types.RGB)
+            shapes = fn.peek_image_shape(jpegs)
+        images = fn.resize(images, resize_x=feed_width, resize_y=feed_height,
+                           interp_type=types.INTERP_LANCZOS3)
+        # crop_mirror_normalize has a fused kernel for the normalization + layout transpose
+        images = fn.crop_mirror_normalize(
+            images, dtype=types.FLOAT, output_layout='CHW',
+            mean=[0., 0., 0.], std=[255., 255., 255.], mirror=0)
+        return images, shapes
+
+    pipe = inference_pipe(batch_size=args.batch_size, num_threads=max(args.num_workers, 1),
+                          device_id=device.index or 0)
+    pipe.build()
+    dali_iter = DALIGenericIterator(pipe, ["images", "shapes"], reader_name="Reader",
+                                    last_batch_policy=LastBatchPolicy.PARTIAL)
+
+    idx = 0
+    for data in dali_iter:
+        input_images = data[0]["images"]
+        original_sizes = [(int(shape[0]), int(shape[1])) for shape in data[0]["shapes"]]
+        image_paths = paths[idx:idx + len(original_sizes)]
+        idx += len(original_sizes)
+        yield input_images, image_paths, original_sizes
+
+
+def colormap_indices(disps, size, buffers=None):
+    """Upsamples a Bx1xHxW batch of disparities to size (height, width) and maps it to
+    uint8 magma colormap indices, normalizing each image between its min and 95th percentile.
+    If a buffers dict is given, the normalization is done in place in device buffers that
+    are cached in it by shape and reused across batches.
+    """
+    disps_resized = torch.nn.functional.interpolate(
+        disps, size, mode="bilinear", align_corners=False).squeeze(1)
+
+    shape = tuple(disps_resized.shape)
+    if buffers is None:
+        buffers = {}
+    if shape not in buffers:
+        buffers[shape] = (torch.empty_like(disps_resized),
+                          torch.empty(shape, dtype=torch.uint8, device=disps.device))
+    norm_buffer, idx_buffer = buffers[shape]
+
+    flat_disps = disps_resized.flatten(1)
+    vmin = flat_disps.min(dim=1)[0].view(-1, 1, 1)
+    vmax = torch.quantile(flat_disps, 0.95, dim=1).view(-1, 1, 1)
+    # same binning as matplotlib's Normalize + ScalarMappable with 256 colours
+    scale = torch.where(vmax > vmin, 256.0 / (vmax - vmin), torch.zeros_like(vmax))
+    torch.sub(disps_resized, vmin, out=norm_buffer)
+    norm_buffer.mul_(scale).clamp_(0, 255)
+    idx_buffer.copy_(norm_buffer)
+    return idx_buffer
+
+
+class PredictionStager(object):
+    """Copies the predictions and colormap indices of a batch to pinned host buffers
+    without blocking, with a single synchronization per batch when they are read back.
+    The buffers are reused, so a staged batch must be read (wait) before the next is staged.
+    """
+    def __init__(self, batch_size, feed_height, feed_width, device):
+        self.use_cuda = device.type == "cuda"
+        self.preds = torch.empty(batch_size, feed_height, feed_width, pin_memory=self.use_cuda)
+        self.lut_idx = torch.empty(0, dtype=torch.uint8, pin_memory=self.use_cuda)
+
+    def stage(self, preds, lut_idx):
+        """Starts the device to host copy of a Bx1xHxW preds tensor and of a list of
+        HxW uint8 colormap indices, whose sizes can differ
+        """
+        num_images = preds.shape[0]
+        staged_preds = self.preds[:num_images]
+        staged_preds.copy_(preds[:, 0], non_blocking=True)
+
+        total_numel = sum(x.numel() for x in lut_idx)
+        if self.lut_idx.numel() < total_numel:
+            self.lut_idx = torch.empty(total_numel, dtype=torch.uint8, pin_memory=self.use_cuda)
+        staged_lut_idx = []
+        offset = 0
+        for x in lut_idx:
+            staged = self.lut_idx[offset:offset + x.numel()].view_as(x)
+            staged.copy_(x, non_blocking=True)
+            staged_lut_idx.append(staged)
+            offset += x.numel()
+
+        event = None
+        if self.use_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        return staged_preds, staged_lut_idx, event
+
+    def wait(self, staged):
+        """Blocks until the copies of a staged batch are done and returns its host tensors
+        """
+        staged_preds, staged_lut_idx, event = staged
+        if event is not None:
+            event.synchronize()
+        return staged_preds, staged_lut_idx
+
+
+def load_half_state_dict(path, device):
+    """Loads a checkpoint, preferring the fp16 copy saved next to it (path + '.fp16').
+    The copy is (re)created when it is missing, older than the checkpoint (e.g. after a
+    retrain) or unreadable, so that later runs read half the bytes.
+    """
+    half_path = path + ".fp16"
+    if os.path.isfile(half_path) and os.path.getmtime(half_path) >= os.path.getmtime(path):
+        try:
+            return torch.load(half_path, map_location=device)
+        except Exception as e:
+            print("   Could not load fp16 weights from {} ({}), rebuilding them".format(
+                half_path, e))
+
+    state_dict = torch.load(path, map_location=device)
+    # non tensor entries (e.g. the encoder 'height' and 'width') are kept as they are
+    state_dict = {k: v.half() if torch.is_tensor(v) and v.is_floating_point() else v
+                  for k, v in state_dict.items()}
+
+    # written to a temporary file and then moved into place, so that an interrupted or
+    # concurrent run never leaves a truncated cache behind
+    tmp_path = "{}.{}.tmp".format(half_path, os.getpid())
+    try:
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, half_path)
+    except (IOError, OSError):
+        print("   Could not cache fp16 weights to", half_path)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    return state_dict
+
+
 def test_simple(args):
     """Function to predict for a single image or folder of images
     """
@@ -112,26 +399,42 @@ def test_simple(args):
     else:
         raise Exception('Can not find resnet {}'.format(args.resnet))
 
-    loaded_dict_enc = torch.load(encoder_path, map_location=device)
+    loaded_dict_enc = load_half_state_dict(encoder_path, device)
 
     # extract the height and width of image that this model was trained with
     feed_height = loaded_dict_enc['height']
     feed_width = loaded_dict_enc['width']
-    filtered_dict_enc = {k: v for k, v in loaded_dict_enc.items() if k in encoder.state_dict()}
+    # load_state_dict casts the fp16 weights back to the fp32 parameters
+    encoder_keys = set(encoder.state_dict().keys())
+    filtered_dict_enc = {k: v for k, v in loaded_dict_enc.items() if k in encoder_keys}
     encoder.load_state_dict(filtered_dict_enc)
-    encoder.to(device)
+    # channels_last lets cuDNN pick the Tensor Core kernels under fp16 autocast
+    encoder.to(device, memory_format=torch.channels_last)
     encoder.eval()
 
     print("   Loading pretrained decoder")
     depth_decoder = networks.DepthDecoder(
         num_ch_enc=encoder.num_ch_enc, scales=range(4))
 
-    loaded_dict = torch.load(depth_decoder_path, map_location=device)
+    loaded_dict = load_half_state_dict(depth_decoder_path, device)
     depth_decoder.load_state_dict(loaded_dict)
 
-    depth_decoder.to(device)
+    depth_decoder.to(device, memory_format=torch.channels_last)
     depth_decoder.eval()
 
+    # fp16 autocast is only used on CUDA; the autocast contexts below are always created for
+    # "cuda", since a disabled CPU autocast with fp16 still fails on some torch versions (2.1)
+    use_amp = device.type == "cuda"
+
+    if args.compile:
+        # the input shape is fixed, so the compiled graphs can be captured as CUDA graphs.
+        # No fullgraph=True: the dict outputs of DepthDecoder break the graph on some torch
+        # versions (e.g. 2.1), and graph breaks fall back to eager instead of failing
+        print("   Compiling encoder and decoder")
+        compile_mode = "reduce-overhead" if device.type == "cuda" else "default"
+        encoder = torch.compile(encoder, mode=compile_mode)
+        depth_decoder = torch.compile(depth_decoder, mode=compile_mode)
+
     folder = args.model
     run = args.dataset_run
 
@@ -168,10 +471,9 @@ def test_simple(args):
                 side_map = {"2": 2, "3": 3, "l": 2, "r": 3}
                 # open test_files.txt
                 test_file_path = os.path.join(test_files_dir, 'eigen', 'test_files.txt')
-                train_filenames = readlines(test_file_path)
-                for file in train_filenames:
-                    splitted = file.split(' ')
-                    paths.append(os.path.join(splitted[0], side_map[splitted[2]], "{}{}".format(splitted[1], '.jpg')))
+                lines = [line.split(' ') for line in readlines(test_file_path)]
+                paths = ["{}/{}/{}.jpg".format(folder, side_map[side], frame)
+                         for folder, frame, side in lines]
         # OXFORD path finder
         if args.dataset == 'OXFORD':
             # Searching folder for images
@@ -179,81 +481,123 @@ def test_simple(args):
                 side_map = {"l": "left", "r": "right"}
                 # open test_files.txt
                 test_file_path = os.path.join(test_files_dir, 'oxford', 'test_files.txt')
-                train_filenames = readlines(test_file_path)
-                for file in train_filenames:
-                    splitted = file.split(' ')
-                    paths.append(os.path.join(splitted[0], side_map[splitted[2]], "{}{}".format(splitted[1], '.jpg')))
+                lines = [line.split(' ') for line in readlines(test_file_path)]
+                paths = ["{}/{}/{}.jpg".format(folder, side_map[side], frame)
+                         for folder, frame, side in lines]
     else:
         raise Exception("Can not find args.image_path: {}".format(args.image_path))
 
-    print("-> Predicting on {:d} test images".format(len(paths)))
-
-    # PREDICTING ON EACH IMAGE IN TURN
-    with torch.no_grad():
-        for idx, image_path in enumerate(paths):
-
-            if image_path.endswith("_disp.jpg"):
-                # don't try to predict disparity for a disparity image!
-                continue
-
-            # Load image and preprocess
-            input_image = pil.open(image_path).convert('RGB')
+    # don't try to predict disparity for a disparity image!
+    paths = [p for p in paths if not p.endswith("_disp.jpg")]
 
-            # effettuo il crop dell'immagine se il dataset è OXFORD
-            if args.dataset == 'OXFORD':
-                crop_area = tuple(args.crop_area)
-                input_image = input_image.crop(crop_area)
+    print("-> Predicting on {:d} test images".format(len(paths)))
 
-            original_width, original_height = input_image.size
-            input_image = input_image.resize((feed_width, feed_height), pil.LANCZOS)
-            input_image = transforms.ToTensor()(input_image).unsqueeze(0)
+    if args.compile and paths:
+        # warm up twice on every batch shape of the run (the full batches and the last,
+        # partial one), to trigger the compilation and then the graph capture before predicting
+        warmup_batch_sizes = set([min(args.batch_size, len(paths))])
+        if len(paths) % args.batch_size:
+            warmup_batch_sizes.add(len(paths) % args.batch_size)
+        with torch.no_grad(), torch.autocast("cuda", dtype=torch.float16, enabled=use_amp):
+            for warmup_batch_size in sorted(warmup_batch_sizes):
+                dummy_input = torch.zeros(
+                    warmup_batch_size, 3, feed_height, feed_width, device=device)
+                dummy_input = dummy_input.contiguous(memory_format=torch.channels_last)
+                for _ in range(2):
+                    depth_decoder(encoder(dummy_input))
+
+    crop_area = tuple(args.crop_area) if args.dataset == 'OXFORD' else None
+    if args.dali:
+        batches = load_batches_dali(paths, feed_width, feed_height, crop_area, device, args)
+    else:
+        batches = load_batches(paths, feed_width, feed_height, crop_area, device, args)
+
+    # all the predictions are written to a single (N, height, width) array, as expected by
+    # evaluate_depth.py --ext_disp_to_eval; the order of the images is saved alongside
+    npy_name = "depths.npy" if args.pred_metric_depth else "disps.npy"
+    name_dest_npy = os.path.join(output_directory, npy_name)
+    pred_writer = np.lib.format.open_memmap(
+        name_dest_npy, mode='w+', dtype=np.float32, shape=(len(paths), feed_height, feed_width))
+    with open(os.path.join(output_directory, "filenames.txt"), 'w') as f:
+        f.writelines("{}\n".format(p) for p in paths)
+
+    if args.pred_metric_depth:
+        if args.dataset == 'KITTI':
+            stereo_scale_factor = STEREO_SCALE_FACTOR
+            print('-> KITTI STEREO_SCALE_FACTOR', stereo_scale_factor)
+        if args.dataset == 'OXFORD':
+            # oxford baseline between left and right cameras
+            oxford_baseline = 0.24
+            stereo_scale_factor = oxford_baseline / 0.1
+            print('-> OXFORD STEREO_SCALE_FACTOR', stereo_scale_factor)
 
-            # PREDICTION
-            input_image = input_image.to(device)
-            features = encoder(input_image)
-            outputs = depth_decoder(features)
+    stager = PredictionStager(args.batch_size, feed_height, feed_width, device)
+    colormap_buffers = {}
 
-            disp = outputs[("disp", 0)]
-            disp_resized = torch.nn.functional.interpolate(
-                disp, (original_height, original_width), mode="bilinear", align_corners=False)
-
-            # Saving numpy file
-            output_name = os.path.splitext(os.path.basename(image_path))[0]
-            scaled_disp, depth = disp_to_depth(disp, 0.1, 100)
-            if args.pred_metric_depth:
-                #name_dest_npy = os.path.join(output_directory, "{}_depth.npy".format(folder + '_' + output_name))
-                name_dest_npy = os.path.join(output_directory, "{}_depth.npy".format(output_name))
-                if args.dataset == 'KITTI':
-                    print('-> KITTI STEREO_SCALE_FACTOR', STEREO_SCALE_FACTOR)
-                    metric_depth = STEREO_SCALE_FACTOR * depth.cpu().numpy()
-                if args.dataset == 'OXFORD':
-                    # oxford baseline between left and right cameras
-                    oxford_baseline = 0.24
-                    stereo_scale_factor = oxford_baseline / 0.1
-                    metric_depth = stereo_scale_factor * depth.cpu().numpy()
-                    print('-> OXFORD STEREO_SCALE_FACTOR', stereo_scale_factor)
-                np.save(name_dest_npy, metric_depth)
-            else:
-                #name_dest_npy = os.path.join(output_directory, "{}_disp.npy".format(folder +'_' + output_name))
-                name_dest_npy = os.path.join(output_directory, "{}_disp.npy".format(output_name))
-                np.save(name_dest_npy, scaled_disp.cpu().numpy())
+    def save_predictions(staged, image_paths, first_idx):
+        """Writes a staged batch to the predictions array and the colormapped images
+        """
+        staged_preds, staged_lut_idx = stager.wait(staged)
+        pred_writer[first_idx:first_idx + len(image_paths)] = staged_preds.numpy()
 
+        for b, image_path in enumerate(image_paths):
             # Saving colormapped depth image
-            disp_resized_np = disp_resized.squeeze().cpu().numpy()
-            vmax = np.percentile(disp_resized_np, 95)
-            normalizer = mpl.colors.Normalize(vmin=disp_resized_np.min(), vmax=vmax)
-            mapper = cm.ScalarMappable(norm=normalizer, cmap='magma')
-            colormapped_im = (mapper.to_rgba(disp_resized_np)[:, :, :3] * 255).astype(np.uint8)
+            colormapped_im = _MAGMA_LUT[staged_lut_idx[b].numpy()]
             im = pil.fromarray(colormapped_im)
 
+            output_name = os.path.splitext(os.path.basename(image_path))[0]
             #name_dest_im = os.path.join(output_directory, "{}_disp.jpeg".format(folder + '_' + output_name))
             name_dest_im = os.path.join(output_directory, "{}_disp.jpeg".format(output_name))
             im.save(name_dest_im)
 
             print("   Processed {:d} of {:d} images - saved predictions to:".format(
-                idx + 1, len(paths)))
+                first_idx + b + 1, len(paths)))
             print("   - {}".format(name_dest_im))
-            print("   - {}".format(name_dest_npy))
+
+    # PREDICTING ON EACH BATCH IN TURN
+    # the results of each batch are copied back asynchronously and saved while the device
+    # predicts on the next batch
+    idx = 0
+    pending = None
+    with torch.no_grad():
+        for input_images, image_paths, original_sizes in batches:
+
+            # PREDICTION
+            input_images = input_images.contiguous(memory_format=torch.channels_last)
+            with torch.autocast("cuda", dtype=torch.float16, enabled=use_amp):
+                features = encoder(input_images)
+                outputs = depth_decoder(features)
+
+            # back to fp32 so that the bilinear upsampling and the saved maps keep full precision
+            disps = outputs[("disp", 0)].float()
+
+            if args.pred_metric_depth:
+                preds = fast_disp_to_depth(disps, 0.1, 100, stereo_scale_factor)
+            else:
+                preds, _ = disp_to_depth(disps, 0.1, 100)
+
+            # the colormap normalization runs on the device, so only the uint8 colormap
+            # indices are copied back
+            if len(set(original_sizes)) == 1:
+                # e.g. OXFORD, where all the crops have the same size
+                lut_idx = list(colormap_indices(disps, original_sizes[0], colormap_buffers))
+            else:
+                # the buffers can not be shared by images of the same batch, which are all
+                # staged together at the end
+                lut_idx = [colormap_indices(disps[b:b + 1], size)[0]
+                           for b, size in enumerate(original_sizes)]
+
+            if pending is not None:
+                save_predictions(*pending)
+            pending = (stager.stage(preds, lut_idx), image_paths, idx)
+            idx += len(image_paths)
+
+        if pending is not None:
+            save_predictions(*pending)
+
+    # flush the memory mapped predictions to disk
+    pred_writer.flush()
+    print("-> Saved predictions to {}".format(name_dest_npy))
 
     print('-> Done!')
 
@@ -165,24 +165,23 @@ class Trainer:
         num_train_samples = len(train_filenames)
         self.num_total_steps = num_train_samples // self.opt.batch_size * self.opt.num_epochs
 
-        # per effettuare il resize di Oxford
+        # il crop di Oxford viene effettuato direttamente da OXFORDDataset.get_color
         mytransform = None
-        if self.opt.dataset == 'oxford':
-            #transform = torchvision.transforms.Compose([oxford_crop])
-            mytransform = MyCompose([oxford_crop])
 
         train_dataset = self.dataset(
             self.opt.data_path, train_filenames, self.opt.height, self.opt.width,
             self.opt.frame_ids, 4, is_train=True, img_ext=img_ext, mytransform=mytransform)
         self.train_loader = DataLoader(
             train_dataset, self.opt.batch_size, True,
-            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True)
+            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True,
+            persistent_workers=self.opt.num_workers > 0)
         val_dataset = self.dataset(
             self.opt.data_path, val_filenames, self.opt.height, self.opt.width,
             self.opt.frame_ids, 4, is_train=False, img_ext=img_ext, mytransform=mytransform)
         self.val_loader = DataLoader(
             val_dataset, self.opt.batch_size, True,
-            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True)
+            num_workers=self.opt.num_workers, pin_memory=True, drop_last=True,
+            persistent_workers=self.opt.num_workers > 0)
         self.val_iter = iter(self.val_loader)
 
         self.writers = {}
@@ -717,21 +716,3 @@ class Trainer:
         else:
             print("Cannot find Adam weights so Adam is randomly initialized")
 
-
-def oxford_crop(image, crop_area):
-    """
-    Permette di eseguire il crop delle immagini di oxford online.
-    Viene rimosso il veicolo con sopra le camere ultimi (160 pixel in altezza)
-    """
-    image = image.crop(crop_area)
-    return image
-
-
-class MyCompose(object):
-    def __init__(self, transforms):
-        self.transforms = transforms
-
-    def __call__(self, image, crop_area):
-        for t in self.transforms:
-            image = t(image, crop_area)
-        return image
\ No newline at end of file